@@ -0,0 +1,101 @@
+"""Benchmark de arranque: tiempo de importación, de restauración del estado y hasta tener
+un usuario conectado tras la ráfaga de ECHO. Termina con código 1 si alguno supera su límite."""
+import os
+import sys
+import time
+import struct
+import tempfile
+import threading
+import subprocess
+
+LIMITE_IMPORTACION = 0.03      # segundos
+LIMITE_RESTAURACION = 0.003    # segundos
+LIMITE_PRIMERA_LISTA = 0.01    # segundos; sin la ráfaga serían hasta INTERVALO_AUTODESCUBRIMIENTO
+USUARIOS = 200
+
+def medir_importacion():
+    """Importa chat_lan en un intérprete nuevo y comprueba que no abre sockets"""
+    codigo = ("import time; inicio = time.perf_counter(); import chat_lan; "
+              "print(time.perf_counter() - inicio, chat_lan.udp_socket is None)")
+    salida = subprocess.run([sys.executable, '-c', codigo], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.split()
+    return float(salida[0]), salida[1] == 'True'
+
+def medir_restauracion():
+    """Guarda un estado con USUARIOS usuarios vistos, grupos e historial y mide cuánto tarda en restaurarse"""
+    import chat_lan
+
+    for i in range(USUARIOS):
+        user_id = i.to_bytes(20, 'big')
+        chat_lan.usuarios_vistos[user_id] = (f"192.168.235.{i % 250 + 1}", time.time())
+        chat_lan.historial_mensajes[user_id] = chat_lan.deque(
+            [("12:00:00", f"mensaje {j}", 'enviado') for j in range(10)], maxlen=10)
+    for i in range(20):
+        chat_lan.grupos_creados[f"grupo{i}"] = list(chat_lan.usuarios_vistos)[:10]
+    chat_lan.guardar_estado()
+
+    chat_lan.usuarios_vistos.clear()
+    chat_lan.grupos_creados.clear()
+    chat_lan.historial_mensajes.clear()
+
+    inicio = time.perf_counter()
+    chat_lan.cargar_estado()
+    duracion = time.perf_counter() - inicio
+    assert len(chat_lan.usuarios_vistos) == USUARIOS
+    return duracion
+
+class UsuarioSimulado:
+    """Socket falso: un usuario de la red que responde a los ECHO dirigidos a su IP o a broadcast"""
+    def __init__(self, chat_lan, user_id, ip):
+        self.chat_lan = chat_lan
+        self.user_id = user_id
+        self.ip = ip
+
+    def sendto(self, data, addr):
+        if len(data) == self.chat_lan.HEADER_SIZE and data[40] == self.chat_lan.ECHO \
+                and addr[0] in (self.ip, self.chat_lan.BROADCAST_ADDR):
+            # Igual que lector_udp con la respuesta recibida
+            respuesta = struct.pack('!B 20s 4s', self.chat_lan.OK, self.user_id, b'\x00'*4)
+            self.chat_lan.cola_echo.put((respuesta, (self.ip, self.chat_lan.PUERTO)))
+
+def medir_primera_lista():
+    """Arranca la ráfaga de ECHO y procesar_echo y mide cuánto tarda un usuario restaurado en pasar a conectado"""
+    import chat_lan
+
+    user_id = (USUARIOS - 1).to_bytes(20, 'big')
+    ip = chat_lan.usuarios_vistos[user_id][0]
+    chat_lan.udp_socket = UsuarioSimulado(chat_lan, user_id, ip)
+
+    inicio = time.perf_counter()
+    threading.Thread(target=chat_lan.procesar_echo, daemon=True).start()
+    threading.Thread(target=chat_lan.autodescubrimiento_continuo, daemon=True).start()
+    while user_id not in chat_lan.usuarios_conectados:
+        if time.perf_counter() - inicio > 2:
+            break
+        time.sleep(0.0005)
+    return time.perf_counter() - inicio
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    importacion, sin_socket = medir_importacion()
+    directorio = os.getcwd()
+    with tempfile.TemporaryDirectory() as temporal:
+        os.chdir(temporal)
+        try:
+            restauracion = medir_restauracion()
+            primera_lista = medir_primera_lista()
+        finally:
+            os.chdir(directorio)
+
+    print(f"Importación: {importacion * 1000:.1f} ms (límite {LIMITE_IMPORTACION * 1000:.0f} ms)")
+    print(f"Socket abierto al importar: {'no' if sin_socket else 'sí'}")
+    print(f"Restauración del estado ({USUARIOS} usuarios): {restauracion * 1000:.2f} ms "
+          f"(límite {LIMITE_RESTAURACION * 1000:.0f} ms)")
+    print(f"Primer usuario conectado tras la ráfaga de ECHO: {primera_lista * 1000:.1f} ms "
+          f"(límite {LIMITE_PRIMERA_LISTA * 1000:.0f} ms)")
+
+    if importacion > LIMITE_IMPORTACION or restauracion > LIMITE_RESTAURACION \
+            or primera_lista > LIMITE_PRIMERA_LISTA or not sin_socket:
+        print("❌ El arranque superó los límites")
+        sys.exit(1)
+    print("✅ Arranque dentro de los límites")
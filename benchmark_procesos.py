@@ -0,0 +1,54 @@
+"""Benchmark de escalado: valida cuerpos sintéticos con 1, 2, 4 y 8 procesos trabajadores"""
+import sys
+import time
+import threading
+from queue import Queue
+
+import chat_lan
+from chat_lan import iniciar_trabajadores, repartir_cuerpos, validar_cuerpo
+
+TOTAL_CUERPOS = 200000
+USUARIOS = 64
+
+def generar_cuerpos():
+    cuerpos = []
+    for i in range(TOTAL_CUERPOS):
+        data = bytes([i % 256]) + f"mensaje número {i} ".encode('utf-8') * 20
+        addr = (f"192.168.235.{i % USUARIOS + 1}", 9990)
+        cuerpos.append((data, addr))
+    return cuerpos
+
+def medir_un_proceso(cuerpos):
+    inicio = time.perf_counter()
+    for data, _ in cuerpos:
+        validar_cuerpo(data)
+    return time.perf_counter() - inicio
+
+def medir_trabajadores(cuerpos, n):
+    entradas, salida = iniciar_trabajadores(n)
+    cola = Queue()
+    threading.Thread(target=repartir_cuerpos, args=(cola, entradas), daemon=True).start()
+
+    inicio = time.perf_counter()
+    for cuerpo in cuerpos:
+        cola.put(cuerpo)
+    recibidos = 0
+    while recibidos < len(cuerpos):
+        recibidos += len(salida.get())
+    duracion = time.perf_counter() - inicio
+
+    for entrada in entradas:
+        entrada.put(None)
+    return duracion
+
+if __name__ == '__main__':
+    # Importar chat_lan no debe abrir el puerto: en un nodo en marcha, otro socket en 9990 le robaría el tráfico
+    if chat_lan.udp_socket is not None:
+        print("❌ chat_lan abrió el socket UDP al importarse; no se ejecuta el benchmark")
+        sys.exit(1)
+    cuerpos = generar_cuerpos()
+    base = medir_un_proceso(cuerpos)
+    print(f"Proceso principal: {base:.2f}s ({len(cuerpos) / base:,.0f} cuerpos/s)")
+    for n in (1, 2, 4, 8):
+        duracion = medir_trabajadores(cuerpos, n)
+        print(f"{n} trabajador(es): {duracion:.2f}s ({len(cuerpos) / duracion:,.0f} cuerpos/s)")
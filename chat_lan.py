@@ -2,8 +2,10 @@ import os
 import time
 import socket
 import struct
+import sys
 import threading 
-from queue import Queue 
+import multiprocessing
+from queue import Queue, Empty
 from collections import deque
 import json
 import shutil
@@ -29,12 +31,26 @@ OK = 0
 PETICION_INVALIDA = 1
 ERROR_INTERNO = 2
 
+#Tipo de confirmación (primer byte reservado de la respuesta, el segundo lleva el mensaje_id)
+CONFIRMA_ECHO = 0      # respuesta a ECHO; también las respuestas sin detalle
+CONFIRMA_HEADER = 1
+CONFIRMA_CUERPO = 2
+
 #Configuración                       
 TIEMPO_INACTIVIDAD = TIMEOUT * 3 
 INTERVALO_AUTODESCUBRIMIENTO = 15
+PROCESOS_CUERPOS = 0   # 0 = validar los cuerpos en el proceso principal; se cambia con --procesos N
+TAMANO_LOTE = 64
+MAX_PENDIENTES = 50            # mensajes/archivos en espera por usuario
+TTL_PENDIENTES = 24 * 3600     # segundos que un pendiente sigue siendo válido
+ARCHIVO_BANDEJA = "bandeja_salida.json"
+ARCHIVO_ESTADO = "estado.bin"
+EDAD_MAXIMA_ESTADO = 3600      # segundos; usuarios vistos hace más tiempo no se restauran
+RAFAGA_DESCUBRIMIENTO = 3      # ECHO enviados al arrancar, separados por 0.2 s
 
 mi_id = os.urandom(20)  
 usuarios_conectados = {}  
+usuarios_vistos = {}           # último (ip, contacto) de cada usuario, aunque ya no esté conectado
 historial_mensajes = {}
 tcp_server_running = True
 archivos_pendientes = {}
@@ -45,7 +61,6 @@ archivos_lock = threading.Lock()
 cola_echo = Queue()
 cola_mensajes = Queue()
 cola_cuerpos = Queue()
-cola_respuestas = Queue()
 mensajes_recibidos = Queue()
 cola_transferencias = Queue()
 
@@ -58,46 +73,91 @@ mensaje_headers_lock = threading.Lock()
 grupos_creados = {}  
 grupos_lock = threading.Lock()
 
-udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-udp_socket.bind(('0.0.0.0', PUERTO))
+bandeja_salida = {}
+bandeja_en_curso = set()       # usuarios con una entrega de pendientes en marcha
+ultimo_vaciado = {}            # user_id -> momento en que empezó su última entrega
+bandeja_lock = threading.Lock()
+
+confirmaciones = set()         # (user_id, tipo, mensaje_id) recibidas y aún no consumidas
+confirmaciones_sin_tipo = {}   # user_id -> OK sin tipo (LCP original) recibidos mientras se le esperaba
+esperas_activas = {}           # user_id -> hilos esperando una confirmación suya
+usuarios_tipados = set()       # usuarios que ya enviaron confirmaciones con tipo
+confirmaciones_cond = threading.Condition()
+siguiente_mensaje_id = os.urandom(1)[0]
+
+# Se crea solo desde __main__: los procesos trabajadores (spawn/forkserver) reimportan este módulo
+# y no deben asociar otro socket al puerto 9990.
+udp_socket = None
+pools_iniciados = set()
+pools_lock = threading.Lock()
+
+def crear_socket_udp():
+    """Crea el socket UDP y lo asocia al puerto del protocolo"""
+    global udp_socket
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    udp_socket.bind(('0.0.0.0', PUERTO))
 
 def iniciar_servicios():
-    """Inicia los hilos para los diferentes servicios"""
+    """Inicia los hilos para los diferentes servicios.
+    Los pools de mensajes, grupos y transferencias arrancan con el primer paquete que los necesita."""
+    # Los procesos trabajadores se lanzan antes que cualquier hilo
+    if PROCESOS_CUERPOS > 0:
+        entradas, salida = iniciar_trabajadores(PROCESOS_CUERPOS)
     threading.Thread(target=lector_udp, daemon=True).start()
     threading.Thread(target=procesar_echo, daemon=True).start()
-    threading.Thread(target=procesar_cuerpos, daemon=True).start()
-    threading.Thread(target=procesar_transferencias, daemon=True).start()
+    if PROCESOS_CUERPOS > 0:
+        threading.Thread(target=repartir_cuerpos, args=(cola_cuerpos, entradas), daemon=True).start()
+        threading.Thread(target=recolectar_cuerpos, args=(salida,), daemon=True).start()
+    else:
+        threading.Thread(target=procesar_cuerpos, daemon=True).start()
+    threading.Thread(target=autodescubrimiento_continuo, daemon=True).start()
     threading.Thread(target=mostrar_mensajes_auto, daemon=True).start()
     threading.Thread(target=servidor_tcp, daemon=True).start()
-    threading.Thread(target=autodescubrimiento_continuo, daemon=True).start()
     threading.Thread(target=verificar_inactividad, daemon=True).start()
 
-    for _ in range(5):
-        threading.Thread(target=procesar_mensajes, daemon=True).start()
-        threading.Thread(target=procesar_creacion_grupos, daemon=True).start()
-        threading.Thread(target=procesar_union_a_grupos, daemon=True).start()
+def iniciar_pool(objetivo, n):
+    """Arranca n hilos de `objetivo` la primera vez que se piden"""
+    if objetivo in pools_iniciados:
+        return
+    with pools_lock:
+        if objetivo in pools_iniciados:
+            return
+        pools_iniciados.add(objetivo)
+    for _ in range(n):
+        threading.Thread(target=objetivo, daemon=True).start()
     
 def lector_udp():
     while tcp_server_running:
         try:
             data, addr = udp_socket.recvfrom(65507)
             if len(data) == 25:
-                cola_respuestas.put(data)
+                if data[0] == OK and data[21] in (CONFIRMA_HEADER, CONFIRMA_CUERPO):
+                    registrar_confirmacion(data[1:21], data[21], data[22])
+                elif data[0] == OK and data[21:] == b'\x00'*4:
+                    # Sin tipo: o es una confirmación de un nodo con el LCP original, o la respuesta a nuestro ECHO
+                    if not registrar_confirmacion_sin_tipo(data[1:21]):
+                        cola_echo.put((data, addr))
             elif len(data) >= 41:
                 op = data[40]
                 if op == ECHO:
                     cola_echo.put((data, addr))
                 elif op == MENSAJE:
+                    iniciar_pool(procesar_mensajes, 5)
                     cola_mensajes.put((data, addr))
                 elif op == ARCHIVO:
+                    iniciar_pool(procesar_transferencias, 1)
                     cola_transferencias.put((data, addr))
                 elif op == CREAR_GRUPO:
+                    iniciar_pool(procesar_creacion_grupos, 5)
                     cola_creacion.put((data, addr))
                 elif op == UNIRSE_A_GRUPO:
+                    iniciar_pool(procesar_union_a_grupos, 5)
+                    iniciar_pool(procesar_mensajes, 5)
                     cola_union.put((data, addr))
                 elif op == MENSAJE_GRUPAL:
+                    iniciar_pool(procesar_mensajes, 5)
                     cola_mensajes.put((data, addr)) 
                 else:
                     print(f"[LCP] Operación desconocida: {op}")
@@ -109,24 +169,65 @@ def lector_udp():
 def procesar_echo():
     while True:
         data, addr = cola_echo.get()
+        if len(data) == RESPONSE_SIZE:
+            registrar_usuario(data[1:21], addr[0])
+            continue
         user_id_from = data[:20]
         if user_id_from == mi_id:
             continue
-        ip_remota = addr[0]
-        with usuarios_lock:
-            ya_conocido = user_id_from in usuarios_conectados
-            usuarios_conectados[user_id_from] = (ip_remota, time.time())
-        if not ya_conocido:
-            print(f"[LCP] Usuario descubierto: {user_id_from.hex()[:8]} desde IP {ip_remota}")
+        registrar_usuario(user_id_from, addr[0])
         if data[20:40] == BROADCAST_ID:
             respuesta = struct.pack('!B 20s 4s', OK, mi_id, b'\x00'*4)
             udp_socket.sendto(respuesta, addr)
 
+def registrar_usuario(user_id, ip_remota):
+    """Marca a un usuario como activo y le entrega lo que tenga pendiente.
+    Si sigue conectado, la entrega se reintenta como mucho una vez por INTERVALO_AUTODESCUBRIMIENTO."""
+    if user_id == mi_id:
+        return
+    ahora = time.time()
+    with usuarios_lock:
+        nuevo = user_id not in usuarios_conectados
+        usuarios_conectados[user_id] = (ip_remota, ahora)
+        usuarios_vistos[user_id] = (ip_remota, ahora)
+    if nuevo:
+        print(f"[LCP] Usuario descubierto: {user_id.hex()[:8]} desde IP {ip_remota}")
+    iniciar_vaciado(user_id, 0 if nuevo else INTERVALO_AUTODESCUBRIMIENTO)
+
+def iniciar_vaciado(user_id, espera_minima=0):
+    """Lanza la entrega de pendientes de un usuario, salvo que ya haya una en curso
+    o que la última haya empezado hace menos de `espera_minima` segundos"""
+    ahora = time.time()
+    with bandeja_lock:
+        if not bandeja_salida.get(user_id) or user_id in bandeja_en_curso:
+            return
+        if ahora - ultimo_vaciado.get(user_id, 0) < espera_minima:
+            return
+        bandeja_en_curso.add(user_id)
+        ultimo_vaciado[user_id] = ahora
+    threading.Thread(target=vaciar_bandeja_en_curso, args=(user_id,), daemon=True).start()
+
+def vaciar_bandeja_en_curso(user_id):
+    """Ejecuta vaciar_bandeja y libera al usuario para la siguiente entrega"""
+    try:
+        vaciar_bandeja(user_id)
+    finally:
+        with bandeja_lock:
+            bandeja_en_curso.discard(user_id)
+
 def autodescubrimiento_continuo():
-    """Envía periódicamente mensajes de autodescubrimiento"""
-    while True:
+    """Envía una ráfaga de ECHO al arrancar y luego uno periódicamente.
+    La ráfaga también va directa a las IP de los usuarios vistos en la sesión anterior."""
+    with usuarios_lock:
+        ips_vistas = {ip for ip, _ in usuarios_vistos.values()}
+    for _ in range(RAFAGA_DESCUBRIMIENTO):
         enviar_echo()
+        for ip in ips_vistas:
+            enviar_echo(ip)
+        time.sleep(0.2)
+    while True:
         time.sleep(INTERVALO_AUTODESCUBRIMIENTO)
+        enviar_echo()
 
 def verificar_inactividad():
     """Verifica y elimina usuarios inactivos"""
@@ -167,7 +268,7 @@ def procesar_mensajes():
                         'grupo': nombre_grupo,
                         'from' : user_id_from
                     }
-                respuesta = struct.pack('!B 20s 4s', OK, mi_id, b'\x00'*4)
+                respuesta = struct.pack('!B 20s B B 2s', OK, mi_id, CONFIRMA_HEADER, mensaje_id, b'\x00'*2)
                 udp_socket.sendto(respuesta, addr)
             
             elif op_code == MENSAJE:
@@ -177,57 +278,117 @@ def procesar_mensajes():
                             'es_broadcast': user_id_to == BROADCAST_ID,
                             'from': user_id_from
                         }
-                    respuesta = struct.pack('!B 20s 4s', OK, mi_id, b'\x00'*4)
+                    respuesta = struct.pack('!B 20s B B 2s', OK, mi_id, CONFIRMA_HEADER, mensaje_id, b'\x00'*2)
                     udp_socket.sendto(respuesta, addr)
         except Exception as e:
             print(f"[Error al procesar mensaje]: {e}")
             
+def validar_cuerpo(data):
+    """Decodifica y valida un cuerpo de mensaje. Devuelve (mensaje_id, mensaje) o None"""
+    if len(data) < 2:
+        return None
+    try:
+        mensaje_id = data[0]
+        mensaje = data[1:].decode('utf-8', errors='ignore')
+        if not mensaje.strip() or any(ord(c) < 32 for c in mensaje if c != '\n'):
+            return None
+    except:
+        return None
+    return mensaje_id, mensaje
+
 def procesar_cuerpos():
     while True:
         data, addr = cola_cuerpos.get()
-        if len(data) < 2:
-            continue
-        try:
-            mensaje_id = data[0]
-            mensaje = data[1:].decode('utf-8', errors='ignore')
-            if not mensaje.strip() or any(ord(c) < 32 for c in mensaje if c != '\n'):
-                continue
-        except:
-            continue
-            
-        es_broadcast = False
-        user_id_from = None
-        nombre_grupo = None
-        
-        with mensaje_headers_lock:
-            header_info = mensaje_headers.pop(mensaje_id, None) 
-        
-        if header_info:
-            user_id_from = header_info['from']
-            es_broadcast = header_info['es_broadcast']
-            nombre_grupo = header_info.get('grupo') 
-        else:
-            with usuarios_lock:
-                for uid, (ip, _) in usuarios_conectados.items():
-                    if ip == addr[0]:
-                        user_id_from = uid
-                        break
-        if user_id_from:
-            hora = time.strftime("%H:%M:%S")
-            with historial_lock:
-                if nombre_grupo:
-                    historial_mensajes.setdefault(nombre_grupo, deque(maxlen=50)).append((hora, mensaje, 'recibido', user_id_from))
-                elif es_broadcast:
-                    historial_mensajes.setdefault(BROADCAST_ID, deque(maxlen=50)).append((hora, mensaje, 'recibido', user_id_from))
-                else:
-                    historial_mensajes.setdefault(user_id_from, deque(maxlen=10)).append((hora, mensaje, 'recibido'))
-                    mensajes_recibidos.put((user_id_from, hora, mensaje, False, None))
-                    
-            mensajes_recibidos.put((user_id_from, hora, mensaje, es_broadcast, nombre_grupo))
-            if not es_broadcast and not nombre_grupo:
-                respuesta = struct.pack('!B 20s 4s', OK, mi_id, b'\x00'*4)
-                udp_socket.sendto(respuesta, addr)
-                    
+        cuerpo = validar_cuerpo(data)
+        if cuerpo:
+            entregar_cuerpo(cuerpo[0], cuerpo[1], addr)
+
+def trabajador_cuerpos(entrada, salida):
+    """Proceso trabajador: valida lotes de cuerpos y devuelve los válidos"""
+    while True:
+        lote = entrada.get()
+        if lote is None:
+            break
+        validos = []
+        for data, addr in lote:
+            cuerpo = validar_cuerpo(data)
+            if cuerpo:
+                validos.append((cuerpo[0], cuerpo[1], addr))
+        salida.put(validos)
+
+def iniciar_trabajadores(n):
+    """Lanza n procesos trabajadores, cada uno con su propia cola de entrada.
+    Se usa spawn: los trabajadores no heredan hilos ni el socket UDP del proceso principal."""
+    contexto = multiprocessing.get_context('spawn')
+    salida = contexto.Queue()
+    entradas = []
+    for _ in range(n):
+        entrada = contexto.Queue()
+        contexto.Process(target=trabajador_cuerpos, args=(entrada, salida), daemon=True).start()
+        entradas.append(entrada)
+    return entradas, salida
+
+def repartir_cuerpos(cola, entradas):
+    """Agrupa los cuerpos en lotes y los reparte por IP de origen.
+    Todos los cuerpos de un mismo usuario van al mismo trabajador, así se conserva su orden."""
+    while True:
+        lotes = [[] for _ in entradas]
+        data, addr = cola.get()
+        total = 0
+        while True:
+            lotes[hash(addr[0]) % len(entradas)].append((data, addr))
+            total += 1
+            if total >= TAMANO_LOTE:
+                break
+            try:
+                data, addr = cola.get_nowait()
+            except Empty:
+                break
+        for entrada, lote in zip(entradas, lotes):
+            if lote:
+                entrada.put(lote)
+
+def recolectar_cuerpos(salida):
+    """Recoge los cuerpos validados por los trabajadores y los entrega"""
+    while True:
+        for mensaje_id, mensaje, addr in salida.get():
+            entregar_cuerpo(mensaje_id, mensaje, addr)
+
+def entregar_cuerpo(mensaje_id, mensaje, addr):
+    """Registra un cuerpo ya validado en el historial y confirma al emisor"""
+    es_broadcast = False
+    user_id_from = None
+    nombre_grupo = None
+    
+    with mensaje_headers_lock:
+        header_info = mensaje_headers.pop(mensaje_id, None) 
+    
+    if header_info:
+        user_id_from = header_info['from']
+        es_broadcast = header_info['es_broadcast']
+        nombre_grupo = header_info.get('grupo') 
+    else:
+        with usuarios_lock:
+            for uid, (ip, _) in usuarios_conectados.items():
+                if ip == addr[0]:
+                    user_id_from = uid
+                    break
+    if user_id_from:
+        hora = time.strftime("%H:%M:%S")
+        with historial_lock:
+            if nombre_grupo:
+                historial_mensajes.setdefault(nombre_grupo, deque(maxlen=50)).append((hora, mensaje, 'recibido', user_id_from))
+            elif es_broadcast:
+                historial_mensajes.setdefault(BROADCAST_ID, deque(maxlen=50)).append((hora, mensaje, 'recibido', user_id_from))
+            else:
+                historial_mensajes.setdefault(user_id_from, deque(maxlen=10)).append((hora, mensaje, 'recibido'))
+                mensajes_recibidos.put((user_id_from, hora, mensaje, False, None))
+                
+        mensajes_recibidos.put((user_id_from, hora, mensaje, es_broadcast, nombre_grupo))
+        if not es_broadcast and not nombre_grupo:
+            respuesta = struct.pack('!B 20s B B 2s', OK, mi_id, CONFIRMA_CUERPO, mensaje_id, b'\x00'*2)
+            udp_socket.sendto(respuesta, addr)
+                
 def procesar_transferencias():
     """Procesa los headers de transferencia de archivos"""
     while True:
@@ -267,7 +428,7 @@ def procesar_creacion_grupos():
                 time.sleep(0.01)
                 continue
             
-            nombre_grupo = data[41:].rstrip(b'\x00').decode('utf-8').strip()
+            nombre_grupo = data[41:HEADER_SIZE].rstrip(b'\x00').decode('utf-8').strip()
             if not nombre_grupo:
                 continue
             
@@ -318,7 +479,7 @@ def procesar_union_a_grupos():
                 time.sleep(0.01)
                 continue
 
-            nombre_grupo = data[41:].rstrip(b'\x00').decode('utf-8').strip()
+            nombre_grupo = data[41:HEADER_SIZE].rstrip(b'\x00').decode('utf-8').strip()
             if not nombre_grupo:
                 continue
 
@@ -418,8 +579,8 @@ def manejar_conexion_tcp(conn, addr):
     finally:
         conn.close()
 
-def enviar_echo():
-    """Envía mensaje de descubrimiento a toda la red"""
+def enviar_echo(ip_destino=BROADCAST_ADDR):
+    """Envía mensaje de descubrimiento a toda la red (o a una IP concreta)"""
     header = struct.pack('!20s 20s B B 8s 50s',
                         mi_id,     
                         BROADCAST_ID,
@@ -427,17 +588,17 @@ def enviar_echo():
                         0,     
                         b'\x00'*8,                
                         b'\x00'*50)             
-    udp_socket.sendto(header, (BROADCAST_ADDR, PUERTO))
+    udp_socket.sendto(header, (ip_destino, PUERTO))
 
 def enviar_mensaje(user_id_to, mensaje, es_broadcast=False):
     """Envía un mensaje a un usuario específico o a todos (broadcast)"""
     if not es_broadcast and user_id_to not in usuarios_conectados:
-        print("❌ Usuario no encontrado en la lista de conectados.")
+        encolar_pendiente(user_id_to, 'mensaje', mensaje)
         return
 
     ip_destino = BROADCAST_ADDR if es_broadcast else usuarios_conectados[user_id_to][0]
     mensaje_bytes = mensaje.encode('utf-8')
-    mensaje_id = int(time.time() * 1000) % 256
+    mensaje_id = reservar_mensaje_ids(user_id_to, 1)[0]
 
     try:
         header = struct.pack('!20s 20s B B 8s 50s',
@@ -450,41 +611,105 @@ def enviar_mensaje(user_id_to, mensaje, es_broadcast=False):
         udp_socket.sendto(header, (ip_destino, PUERTO))
         print("📤 Header enviado. Esperando OK..." if not es_broadcast else "📤 Header de broadcast enviado")
 
-        if not es_broadcast:
-            respuesta = cola_respuestas.get(timeout=5)
-            if respuesta[0] != OK:
-                print(f"❌ Error en respuesta al header: código {respuesta[0]}")
-                return
+        if not es_broadcast and not esperar_confirmaciones(user_id_to, CONFIRMA_HEADER, [mensaje_id]):
+            print("❌ Sin respuesta al header.")
+            encolar_pendiente(user_id_to, 'mensaje', mensaje)
+            return
 
         cuerpo = struct.pack('!B', mensaje_id) + mensaje_bytes
         udp_socket.sendto(cuerpo, (ip_destino, PUERTO))
         print("📤 Cuerpo enviado. Esperando OK..." if not es_broadcast else "📤 Cuerpo de broadcast enviado")
 
         if not es_broadcast:
-            respuesta = cola_respuestas.get(timeout=5)
-            if respuesta[0] == OK:
+            if esperar_confirmaciones(user_id_to, CONFIRMA_CUERPO, [mensaje_id]):
                 print("✅ Mensaje enviado correctamente.")
                 hora = time.strftime("%H:%M:%S")
                 with historial_lock:
                     historial_mensajes.setdefault(user_id_to, deque(maxlen=10)).append((hora, mensaje, 'enviado'))
             else:
-                print(f"❌ Error en respuesta al cuerpo: código {respuesta[0]}")
+                print("❌ Sin respuesta al cuerpo.")
+                encolar_pendiente(user_id_to, 'mensaje', mensaje)
     except Exception as e:
         print(f"❌ Excepción al enviar mensaje: {e}")
+        if not es_broadcast:
+            encolar_pendiente(user_id_to, 'mensaje', mensaje)
+
+def reservar_mensaje_ids(user_id, n):
+    """Reserva n ids de mensaje consecutivos y descarta confirmaciones viejas de ese usuario con esos ids"""
+    global siguiente_mensaje_id
+    with confirmaciones_cond:
+        ids = [(siguiente_mensaje_id + i) % 256 for i in range(n)]
+        siguiente_mensaje_id = (siguiente_mensaje_id + n) % 256
+        confirmaciones.difference_update((user_id, tipo, mensaje_id) for mensaje_id in ids
+                                         for tipo in (CONFIRMA_HEADER, CONFIRMA_CUERPO))
+    return ids
+
+def registrar_confirmacion(user_id, tipo, mensaje_id):
+    """Anota la confirmación de un header o cuerpo y despierta a quien la espera"""
+    with confirmaciones_cond:
+        usuarios_tipados.add(user_id)
+        confirmaciones_sin_tipo.pop(user_id, None)
+        confirmaciones.add((user_id, tipo, mensaje_id))
+        confirmaciones_cond.notify_all()
+
+def registrar_confirmacion_sin_tipo(user_id):
+    """Anota un OK sin tipo de un nodo con el LCP original.
+    Devuelve False si nadie espera confirmaciones de ese usuario: entonces es una respuesta a ECHO."""
+    with confirmaciones_cond:
+        if user_id in usuarios_tipados or not esperas_activas.get(user_id):
+            return False
+        confirmaciones_sin_tipo[user_id] = confirmaciones_sin_tipo.get(user_id, 0) + 1
+        confirmaciones_cond.notify_all()
+    return True
+
+def esperar_confirmaciones(user_id, tipo, mensaje_ids, timeout=TIMEOUT):
+    """Espera hasta `timeout` las confirmaciones de los mensaje_ids. Devuelve el conjunto de ids confirmados.
+    Los OK sin tipo de un nodo con el LCP original confirman, en orden, los ids más antiguos que falten."""
+    faltan = list(mensaje_ids)
+    confirmados = set()
+    limite = time.time() + timeout
+    with confirmaciones_cond:
+        esperas_activas[user_id] = esperas_activas.get(user_id, 0) + 1
+        try:
+            while True:
+                for mensaje_id in list(faltan):
+                    clave = (user_id, tipo, mensaje_id)
+                    if clave in confirmaciones:
+                        confirmaciones.discard(clave)
+                        faltan.remove(mensaje_id)
+                        confirmados.add(mensaje_id)
+                while faltan and confirmaciones_sin_tipo.get(user_id) and user_id not in usuarios_tipados:
+                    confirmaciones_sin_tipo[user_id] -= 1
+                    confirmados.add(faltan.pop(0))
+                restante = limite - time.time()
+                if not faltan or restante <= 0:
+                    break
+                confirmaciones_cond.wait(restante)
+        finally:
+            esperas_activas[user_id] -= 1
+            if not esperas_activas[user_id]:
+                del esperas_activas[user_id]
+                confirmaciones_sin_tipo.pop(user_id, None)
+    return confirmados
 
 def enviar_archivo(user_id_to, file_path):
     """Envía un archivo a otro usuario"""
-    if user_id_to not in usuarios_conectados:
-        print("❌ Usuario no encontrado en la lista de conectados.")
-        return
-        
     if not os.path.exists(file_path):
         print("❌ El archivo no existe.")
         return
-        
+
+    if user_id_to not in usuarios_conectados:
+        encolar_pendiente(user_id_to, 'archivo', os.path.abspath(file_path))
+        return
+
+    if not transferir_archivo(user_id_to, usuarios_conectados[user_id_to][0], file_path):
+        encolar_pendiente(user_id_to, 'archivo', os.path.abspath(file_path))
+
+def transferir_archivo(user_id_to, ip_destino, file_path):
+    """Envía el header UDP y el contenido por TCP. Devuelve True si el receptor lo confirmó"""
     file_size = os.path.getsize(file_path)
     file_id = os.urandom(8)
-    ip_destino = usuarios_conectados[user_id_to][0]
+    tcp_socket = None
     
     try:
         header = struct.pack('!20s 20s B 8s 8s 16s',
@@ -515,6 +740,7 @@ def enviar_archivo(user_id_to, file_path):
         status = tcp_socket.recv(1)
         if status[0] == OK:
             print("\n✅ Archivo enviado correctamente (OK)")
+            return True
         else:
             print(f"\n❌ Error al enviar archivo: código {status[0]}")
             
@@ -523,7 +749,135 @@ def enviar_archivo(user_id_to, file_path):
     except Exception as e:
         print(f"\n❌ Error al enviar archivo: {e}")
     finally:
-        tcp_socket.close()
+        if tcp_socket:
+            tcp_socket.close()
+    return False
+
+def encolar_pendiente(user_id_to, tipo, contenido):
+    """Guarda un mensaje o archivo para entregarlo cuando el usuario vuelva a aparecer"""
+    with bandeja_lock:
+        pendientes = bandeja_salida.setdefault(user_id_to, deque(maxlen=MAX_PENDIENTES))
+        descartado = pendientes[0] if len(pendientes) == MAX_PENDIENTES else None
+        pendientes.append((time.time(), tipo, contenido))
+    if descartado:
+        print(f"⚠️ Bandeja de {user_id_to.hex()[:8]} llena ({MAX_PENDIENTES}): se descarta el pendiente más antiguo ({descartado[1]}).")
+    guardar_bandeja()
+    print(f"📥 No se pudo entregar a {user_id_to.hex()[:8]}. Se enviará cuando vuelva a aparecer.")
+
+def enviar_mensajes_en_bloque(user_id_to, ip_destino, mensajes):
+    """Envía varios mensajes sin esperar cada OK: primero todos los headers y, una vez confirmados,
+    los cuerpos. Devuelve, para cada mensaje, si su cuerpo se confirmó"""
+    ids = reservar_mensaje_ids(user_id_to, len(mensajes))
+    cuerpos = {}
+    for mensaje_id, mensaje in zip(ids, mensajes):
+        mensaje_bytes = mensaje.encode('utf-8')
+        header = struct.pack('!20s 20s B B 8s 50s',
+                            mi_id,
+                            user_id_to,
+                            MENSAJE,
+                            mensaje_id,
+                            len(mensaje_bytes).to_bytes(8, 'big'),
+                            b'\x00' * 50)
+        udp_socket.sendto(header, (ip_destino, PUERTO))
+        cuerpos[mensaje_id] = struct.pack('!B', mensaje_id) + mensaje_bytes
+
+    # Un cuerpo solo se envía cuando su header está registrado en el receptor
+    con_header = esperar_confirmaciones(user_id_to, CONFIRMA_HEADER, ids)
+    ids_con_header = [mensaje_id for mensaje_id in ids if mensaje_id in con_header]
+    for mensaje_id in ids_con_header:
+        udp_socket.sendto(cuerpos[mensaje_id], (ip_destino, PUERTO))
+    confirmados = esperar_confirmaciones(user_id_to, CONFIRMA_CUERPO, ids_con_header) if ids_con_header else set()
+    return [mensaje_id in confirmados for mensaje_id in ids]
+
+def transferir_pendiente(user_id, ip_destino, indice, ruta, resultados):
+    """Transfiere un archivo pendiente y anota el resultado en resultados[indice]"""
+    resultados[indice] = transferir_archivo(user_id, ip_destino, ruta)
+
+def vaciar_bandeja(user_id):
+    """Entrega en bloque los pendientes de un usuario.
+    Los pendientes siguen en la bandeja (y en disco) mientras se entregan; solo se quitan al confirmarse."""
+    ahora = time.time()
+    with bandeja_lock:
+        cola = bandeja_salida.get(user_id, deque())
+        for pendiente in [p for p in cola if ahora - p[0] > TTL_PENDIENTES]:
+            cola.remove(pendiente)
+        pendientes = list(cola)
+    with usuarios_lock:
+        conexion = usuarios_conectados.get(user_id)
+    if not pendientes or not conexion:
+        guardar_bandeja()
+        return
+
+    print(f"📬 Entregando {len(pendientes)} pendiente(s) a {user_id.hex()[:8]}")
+    resultados = {}
+    descartados = 0
+    hilos = []
+    for i, (_, tipo, contenido) in enumerate(pendientes):
+        if tipo != 'archivo':
+            continue
+        if not os.path.exists(contenido):
+            print(f"⚠️ Archivo pendiente {contenido} ya no existe, se descarta.")
+            resultados[i] = True
+            descartados += 1
+            continue
+        hilo = threading.Thread(target=transferir_pendiente, args=(user_id, conexion[0], i, contenido, resultados))
+        hilo.start()
+        hilos.append(hilo)
+
+    indices_mensajes = [i for i, p in enumerate(pendientes) if p[1] == 'mensaje']
+    if indices_mensajes:
+        confirmados = enviar_mensajes_en_bloque(user_id, conexion[0], [pendientes[i][2] for i in indices_mensajes])
+        resultados.update(zip(indices_mensajes, confirmados))
+    for hilo in hilos:
+        hilo.join()
+
+    hora = time.strftime("%H:%M:%S")
+    with historial_lock:
+        for i in indices_mensajes:
+            if resultados[i]:
+                historial_mensajes.setdefault(user_id, deque(maxlen=10)).append((hora, pendientes[i][2], 'enviado'))
+    # Se quitan solo los confirmados; los demás conservan su sitio en la bandeja
+    with bandeja_lock:
+        cola = bandeja_salida.get(user_id, deque())
+        for i, pendiente in enumerate(pendientes):
+            if resultados.get(i) and pendiente in cola:
+                cola.remove(pendiente)
+        if not cola:
+            bandeja_salida.pop(user_id, None)
+    guardar_bandeja()
+    entregados = sum(1 for r in resultados.values() if r) - descartados
+    print(f"📬 {entregados}/{len(pendientes)} pendiente(s) entregados a {user_id.hex()[:8]}")
+
+def guardar_bandeja():
+    """Guarda en disco los mensajes y archivos pendientes de entrega"""
+    try:
+        with bandeja_lock:
+            bandeja_serializable = {
+                user_id.hex(): [list(p) for p in pendientes]
+                for user_id, pendientes in bandeja_salida.items() if pendientes
+            }
+            with open(ARCHIVO_BANDEJA + ".tmp", "w") as f:
+                json.dump(bandeja_serializable, f)
+            os.replace(ARCHIVO_BANDEJA + ".tmp", ARCHIVO_BANDEJA)
+    except Exception as e:
+        print(f"⚠️ Error al guardar pendientes: {e}")
+
+def cargar_bandeja():
+    """Carga los pendientes de entrega, descartando los que superaron el TTL"""
+    try:
+        with open(ARCHIVO_BANDEJA, "r") as f:
+            bandeja_cargada = json.load(f)
+
+        ahora = time.time()
+        with bandeja_lock:
+            for user_id_hex, pendientes in bandeja_cargada.items():
+                vigentes = [tuple(p) for p in pendientes if ahora - p[0] <= TTL_PENDIENTES]
+                if vigentes:
+                    bandeja_salida[bytes.fromhex(user_id_hex)] = deque(vigentes, maxlen=MAX_PENDIENTES)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Error al cargar pendientes: {e}")
 
 def mostrar_mensajes_auto():
     while True:
@@ -573,6 +927,127 @@ def cargar_historial():
     except Exception as e:
         print(f"⚠️ Error al cargar historial: {e}")
         
+def guardar_estado():
+    """Guarda en formato binario la tabla de usuarios, los grupos y el historial personal reciente"""
+    try:
+        partes = [struct.pack('!4s d', b'LCP1', time.time())]
+
+        with usuarios_lock:
+            usuarios = list(usuarios_vistos.items())
+        partes.append(struct.pack('!H', len(usuarios)))
+        for user_id, (ip, ultimo_contacto) in usuarios:
+            partes.append(struct.pack('!20s 4s d', user_id, socket.inet_aton(ip), ultimo_contacto))
+
+        with grupos_lock:
+            grupos = [(nombre.encode('utf-8'), list(miembros)) for nombre, miembros in grupos_creados.items()]
+        # Un nombre demasiado largo no debe impedir guardar el resto del estado
+        grupos = [(nombre_bytes, miembros) for nombre_bytes, miembros in grupos if len(nombre_bytes) <= 255]
+        partes.append(struct.pack('!H', len(grupos)))
+        for nombre_bytes, miembros in grupos:
+            partes.append(struct.pack('!B H', len(nombre_bytes), len(miembros)) + nombre_bytes + b''.join(miembros))
+
+        with historial_lock:
+            historial = [(user_id, list(mensajes)) for user_id, mensajes in historial_mensajes.items()
+                         if isinstance(user_id, bytes) and user_id != BROADCAST_ID]
+        partes.append(struct.pack('!H', len(historial)))
+        for user_id, mensajes in historial:
+            partes.append(struct.pack('!20s B', user_id, len(mensajes)))
+            for hora, mensaje, tipo in mensajes:
+                mensaje_bytes = mensaje.encode('utf-8')
+                partes.append(struct.pack('!8s B I', hora.encode(), tipo == 'enviado', len(mensaje_bytes)) + mensaje_bytes)
+
+        with open(ARCHIVO_ESTADO + ".tmp", "wb") as f:
+            f.write(b''.join(partes))
+        os.replace(ARCHIVO_ESTADO + ".tmp", ARCHIVO_ESTADO)
+    except Exception as e:
+        print(f"⚠️ Error al guardar estado: {e}")
+
+def cargar_estado():
+    """Restaura el estado guardado por guardar_estado. Devuelve False si no hay uno válido"""
+    try:
+        with open(ARCHIVO_ESTADO, "rb") as f:
+            datos = f.read()
+        magia, _ = struct.unpack_from('!4s d', datos, 0)
+        if magia != b'LCP1':
+            return False
+        pos = struct.calcsize('!4s d')
+        ahora = time.time()
+
+        usuarios = {}
+        (cantidad,) = struct.unpack_from('!H', datos, pos)
+        pos += 2
+        for _ in range(cantidad):
+            user_id, ip, ultimo_contacto = struct.unpack_from('!20s 4s d', datos, pos)
+            pos += struct.calcsize('!20s 4s d')
+            if ahora - ultimo_contacto <= EDAD_MAXIMA_ESTADO:
+                usuarios[user_id] = (socket.inet_ntoa(ip), ultimo_contacto)
+
+        grupos = {}
+        (cantidad,) = struct.unpack_from('!H', datos, pos)
+        pos += 2
+        for _ in range(cantidad):
+            largo, num_miembros = struct.unpack_from('!B H', datos, pos)
+            pos += struct.calcsize('!B H')
+            nombre = datos[pos:pos + largo].decode('utf-8')
+            pos += largo
+            grupos[nombre] = [datos[pos + 20*i:pos + 20*(i + 1)] for i in range(num_miembros)]
+            pos += 20 * num_miembros
+
+        historial = {}
+        (cantidad,) = struct.unpack_from('!H', datos, pos)
+        pos += 2
+        for _ in range(cantidad):
+            user_id, num_mensajes = struct.unpack_from('!20s B', datos, pos)
+            pos += struct.calcsize('!20s B')
+            mensajes = deque(maxlen=10)
+            for _ in range(num_mensajes):
+                hora, enviado, largo = struct.unpack_from('!8s B I', datos, pos)
+                pos += struct.calcsize('!8s B I')
+                mensajes.append((hora.decode(), datos[pos:pos + largo].decode('utf-8'), 'enviado' if enviado else 'recibido'))
+                pos += largo
+            historial[user_id] = mensajes
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        print(f"⚠️ Error al cargar estado: {e}")
+        return False
+
+    # Solo pasan a usuarios_conectados cuando respondan a la ráfaga de ECHO
+    with usuarios_lock:
+        for user_id, valor in usuarios.items():
+            usuarios_vistos.setdefault(user_id, valor)
+    with grupos_lock:
+        for nombre, miembros in grupos.items():
+            grupos_creados.setdefault(nombre, miembros)
+    with historial_lock:
+        historial_mensajes.update(historial)
+    return True
+
+def usuarios_conocidos():
+    """Usuarios a los que se puede escribir: primero los conectados y luego los vistos antes o con historial o pendientes"""
+    with usuarios_lock:
+        usuarios = list(usuarios_conectados)
+        vistos = list(usuarios_vistos)
+    with historial_lock:
+        vistos += [uid for uid in historial_mensajes if isinstance(uid, bytes) and uid != BROADCAST_ID]
+    with bandeja_lock:
+        vistos += list(bandeja_salida)
+    for uid in vistos:
+        if uid not in usuarios:
+            usuarios.append(uid)
+    return usuarios
+
+def mostrar_usuarios(usuarios):
+    print("\n=== USUARIOS DISPONIBLES ===")
+    for i, uid in enumerate(usuarios, 1):
+        with usuarios_lock:
+            conexion = usuarios_conectados.get(uid)
+        if not conexion:
+            estado = "DESCONECTADO"
+        else:
+            estado = "ACTIVO" if (time.time() - conexion[1]) < TIEMPO_INACTIVIDAD/2 else "INACTIVO"
+        print(f"{i}. {uid.hex()[:8]} ({estado})")
+
 def mostrar_menu():
     while True:
         print("\n=== MENÚ PRINCIPAL ===")
@@ -599,15 +1074,12 @@ def mostrar_menu():
                         estado = "ACTIVO" if tiempo_desde_contacto < TIEMPO_INACTIVIDAD/2 else "INACTIVO"
                         print(f"{i}. ID: {uid.hex()[:8]} | IP: {ip} | Estado: {estado}")
         elif opcion == "2":
-            usuarios = list(usuarios_conectados.keys())
+            usuarios = usuarios_conocidos()
             if not usuarios:
-                print("\nNo hay usuarios conectados para enviar mensajes.")
+                print("\nNo hay usuarios conocidos para enviar mensajes.")
                 continue
                 
-            print("\n=== USUARIOS DISPONIBLES ===")
-            for i, uid in enumerate(usuarios, 1):
-                estado = "ACTIVO" if (time.time() - usuarios_conectados[uid][1]) < TIEMPO_INACTIVIDAD/2 else "INACTIVO"
-                print(f"{i}. {uid.hex()[:8]} ({estado})")
+            mostrar_usuarios(usuarios)
                 
             try:
                 idx = int(input("\nSeleccione usuario #: ")) - 1
@@ -622,15 +1094,12 @@ def mostrar_menu():
             msg = input("\nMensaje broadcast: ")
             enviar_mensaje(BROADCAST_ID, msg, es_broadcast=True)
         elif opcion == "4":
-            usuarios = list(usuarios_conectados.keys())
+            usuarios = usuarios_conocidos()
             if not usuarios:
-                print("\nNo hay usuarios conectados para enviar archivos.")
+                print("\nNo hay usuarios conocidos para enviar archivos.")
                 continue
                 
-            print("\n=== USUARIOS DISPONIBLES ===")
-            for i, uid in enumerate(usuarios, 1):
-                estado = "ACTIVO" if (time.time() - usuarios_conectados[uid][1]) < TIEMPO_INACTIVIDAD/2 else "INACTIVO"
-                print(f"{i}. {uid.hex()[:8]} ({estado})")
+            mostrar_usuarios(usuarios)
                 
             try:
                 idx = int(input("\nSeleccione usuario #: ")) - 1
@@ -674,15 +1143,12 @@ def mostrar_menu():
             enviar_mensaje_grupal(nombre, texto)
             
         elif opcion == "8":
-            usuarios = list(usuarios_conectados.keys())
+            usuarios = usuarios_conocidos()
             if not usuarios:
-                print("\nNo hay usuarios conectados para ver historial.")
+                print("\nNo hay usuarios conocidos para ver historial.")
                 continue
                 
-            print("\n=== USUARIOS DISPONIBLES ===")
-            for i, uid in enumerate(usuarios, 1):
-                estado = "ACTIVO" if (time.time() - usuarios_conectados[uid][1]) < TIEMPO_INACTIVIDAD/2 else "INACTIVO"
-                print(f"{i}. {uid.hex()[:8]} ({estado})")
+            mostrar_usuarios(usuarios)
                 
             try:
                 idx = int(input("\nSeleccione usuario #: ")) - 1
@@ -701,7 +1167,16 @@ def mostrar_menu():
             print("❌ Opción no válida. Intente nuevamente.")
 
 if __name__ == '__main__':
-    cargar_historial()
+    if '--procesos' in sys.argv:
+        try:
+            PROCESOS_CUERPOS = int(sys.argv[sys.argv.index('--procesos') + 1])
+        except (IndexError, ValueError):
+            print("❌ Uso: python chat_lan.py [--procesos N]")
+            sys.exit(1)
+    crear_socket_udp()
+    if not cargar_estado():
+        cargar_historial()
+    cargar_bandeja()
     print("Iniciando servicios...")
     iniciar_servicios()
     print("Servicios iniciados correctamente")
@@ -709,5 +1184,7 @@ if __name__ == '__main__':
     try:
         mostrar_menu()
     finally:
-        guardar_historial() 
+        guardar_historial()
+        guardar_estado()
+        guardar_bandeja()
     
\ No newline at end of file